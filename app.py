@@ -1,13 +1,20 @@
 import json
+import os
 import re
+from concurrent.futures import ProcessPoolExecutor
+from itertools import groupby, islice, repeat
 from pathlib import Path
 
-import fitz  # PyMuPDF
-
 
 INPUT_PATH = Path("/content/drive/MyDrive/input.pdf")
 OUTPUT_PATH = Path("/content/drive/MyDrive/exhaustive_toc.json")
 
+# Upper bound on pages a worker handles before closing the document and
+# releasing MuPDF's object store, so memory stays flat on very large PDFs.
+PAGE_BATCH_SIZE = 500
+# Pages between store_shrink calls inside a batch.
+STORE_SHRINK_INTERVAL = 50
+
 
 ROMAN_RE = r"(?:M{0,4}(CM|CD|D?C{0,3})(XC|XL|L?X{0,3})(IX|IV|V?I{0,3}))"
 ARABIC_RE = r"\d+(?:\.\d+)*"
@@ -17,32 +24,52 @@ CHAPTER_KEYWORDS = (
     r"preface|foreword|epilogue|prologue)"
 )
 
+# Branches are tried in the same order as the original sequential checks;
+# only the keyword branch is case-insensitive.
+LEVEL_RE = re.compile(
+    rf"\s*(?:(?P<roman>{ROMAN_RE}\.?\s+)"
+    r"|(?P<d3>\d+\.\d+\.\d+\s+)"
+    r"|(?P<d2>\d+\.\d+\s+)"
+    r"|(?P<d1>\d+\s+)"
+    rf"|(?P<kw>(?i:{CHAPTER_KEYWORDS})\b))"
+)
+LEVEL_BY_GROUP = {"roman": 1, "d3": 3, "d2": 2, "d1": 1, "kw": 1}
+
+# Heading tests for stripped text; see is_heading_candidate.
+KEYWORD_HEADING_RE = re.compile(rf"{CHAPTER_KEYWORDS}\b", re.IGNORECASE)
+ROMAN_HEADING_RE = re.compile(rf"{ROMAN_RE}\.?\s+")
+ARABIC_HEADING_RE = re.compile(rf"{ARABIC_RE}\s+")
+# ROMAN_RE may match empty, so ". Title" is a roman heading as well.
+ROMAN_HEADING_START = "MDCLXVI."
+# Every byte except ASCII letters; non-ASCII text is dropped when encoding.
+NON_LETTER_BYTES = bytes(c for c in range(256) if not (c < 128 and chr(c).isalpha()))
+
+
+# A run of three or more single-character tokens, e.g. "C H A P T E R".
+SPACED_CHARS_RE = re.compile(r"(?<!\S)\S(?: \S){2,}(?!\S)")
+
+
+def join_letters(match: re.Match) -> str:
+    parts = []
+    for is_letter, group in groupby(match.group(0).split(" "), str.isalpha):
+        chars = list(group)
+        if is_letter and len(chars) >= 3:
+            parts.append("".join(chars))
+        else:
+            parts.extend(chars)
+    return " ".join(parts)
+
 
 def normalize(text: str) -> str:
-    text = re.sub(r"\s+", " ", text)
-    return text.strip()
+    return " ".join(text.split())
 
 
 def collapse_spaced_letters(text: str) -> str:
-    tokens = text.split()
-    result = []
-    i = 0
-    while i < len(tokens):
-        if len(tokens[i]) == 1 and tokens[i].isalpha():
-            j = i
-            while j < len(tokens) and len(tokens[j]) == 1 and tokens[j].isalpha():
-                j += 1
-            if j - i >= 3:
-                result.append("".join(tokens[i:j]))
-                i = j
-                continue
-        result.append(tokens[i])
-        i += 1
-    return " ".join(result)
+    return SPACED_CHARS_RE.sub(join_letters, normalize(text))
 
 
 def clean_text(text: str) -> str:
-    return collapse_spaced_letters(normalize(text))
+    return collapse_spaced_letters(text)
 
 
 def is_index_line(text: str) -> bool:
@@ -60,70 +87,122 @@ def is_heading_candidate(text: str) -> bool:
     t = text.strip()
     if len(t) < 3 or len(t) > 300:
         return False
-    if re.match(rf"^\s*{CHAPTER_KEYWORDS}\b", t, re.IGNORECASE):
-        return True
-    if re.match(rf"^\s*{ROMAN_RE}\.?\s+", t):
-        return True
-    if re.match(rf"^\s*{ARABIC_RE}\s+", t):
-        return True
-    letters = re.sub(r"[^A-Za-z]", "", t)
-    if letters and letters.isupper() and len(letters) > 5:
+    # Only the pattern that can match the first character is tried.
+    c0 = t[0]
+    if c0.isdigit():
+        if ARABIC_HEADING_RE.match(t):
+            return True
+    else:
+        if c0.isalpha() and KEYWORD_HEADING_RE.match(t):
+            return True
+        if c0 in ROMAN_HEADING_START and ROMAN_HEADING_RE.match(t):
+            return True
+    letters = t.encode("ascii", "ignore").translate(None, NON_LETTER_BYTES)
+    if len(letters) > 5 and letters.isupper():
         return True
     return False
 
 
 def infer_level(text: str) -> int:
-    t = text.strip()
-    if re.match(rf"^\s*{ROMAN_RE}\.?\s+", t):
-        return 1
-    if re.match(r"^\s*\d+\.\d+\.\d+\s+", t):
-        return 3
-    if re.match(r"^\s*\d+\.\d+\s+", t):
+    m = LEVEL_RE.match(text.strip())
+    if not m:
         return 2
-    if re.match(r"^\s*\d+\s+", t):
-        return 1
-    if re.match(rf"^\s*{CHAPTER_KEYWORDS}\b", t, re.IGNORECASE):
-        return 1
-    return 2
+    return LEVEL_BY_GROUP[m.lastgroup]
+
+
+def page_headings(page):
+    blocks = page.get_text("blocks")
+    # clean_text folds newlines, so each non-empty block is one line.
+    lines_in_order = [
+        text for text in (clean_text(block[4]) for block in blocks) if text
+    ]
+    # Omit first line (page header)
+    start = 1
+    end = len(lines_in_order)
+    # Omit last line if page index
+    if end > start and is_index_line(lines_in_order[-1]):
+        end -= 1
+    return [
+        (infer_level(candidate), candidate)
+        for candidate in islice(lines_in_order, start, end)
+        if is_heading_candidate(candidate)
+    ]
+
+
+def available_cpus() -> int:
+    # Respect CPU affinity (e.g. container limits) where the OS exposes it.
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0)) or 1
+    return os.cpu_count() or 1
+
+
+def iter_range_results(pdf_path: Path, page_ranges, workers: int):
+    # A single range is handled in-process; forking workers that each
+    # import PyMuPDF costs more than a short document takes to read.
+    if len(page_ranges) == 1:
+        yield extract_page_range(pdf_path, page_ranges[0])
+        return
+    workers = min(workers, len(page_ranges))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # map() yields in submission order, so dedup still keeps the
+        # first occurrence in page order.
+        yield from executor.map(extract_page_range, repeat(pdf_path), page_ranges)
+
+
+def extract_page_range(pdf_path: Path, page_indices):
+    # Runs in a worker process: each worker opens its own document, since
+    # a fitz.Document cannot be shared across processes or threads.
+    import fitz  # PyMuPDF
+
+    doc = fitz.open(pdf_path)
+    results = []
+    try:
+        for count, page_index in enumerate(page_indices, 1):
+            page = doc.load_page(page_index)
+            results.append((page_index, page_headings(page)))
+            # Drop the page before shrinking so its resources can be freed
+            page = None
+            if count % STORE_SHRINK_INTERVAL == 0:
+                fitz.TOOLS.store_shrink(100)
+    finally:
+        doc.close()
+    fitz.TOOLS.store_shrink(100)
+    return results
 
 
 def extract_flat_toc(pdf_path: Path):
+    # Imported lazily so a missing input fails without loading PyMuPDF.
+    import fitz  # PyMuPDF
+
     doc = fitz.open(pdf_path)
-    flat_entries = []
-    seen_pairs = set()
-    for page_index in range(len(doc)):
-        page = doc.load_page(page_index)
-        blocks = page.get_text("blocks")
-        lines_in_order = []
-        for block in blocks:
-            text = clean_text(block[4])
-            if not text:
-                continue
-            for line in text.split("\n"):
-                candidate = clean_text(line)
-                if candidate:
-                    lines_in_order.append(candidate)
-        if not lines_in_order:
-            continue
-        # Omit first line (page header)
-        content_lines = lines_in_order[1:]
-        # Omit last line if page index
-        if content_lines and is_index_line(content_lines[-1]):
-            content_lines = content_lines[:-1]
-        for candidate in content_lines:
-            if not is_heading_candidate(candidate):
-                continue
-            level = infer_level(candidate)
-            pair_key = (level, candidate.lower())
-            if pair_key in seen_pairs:
-                continue
-            seen_pairs.add(pair_key)
-            flat_entries.append(
-                {"rank": level, "title": candidate, "page": page_index + 1}
-            )
+    page_count = len(doc)
     doc.close()
-    flat_entries.sort(key=lambda x: (x["page"], x["rank"]))
-    return flat_entries
+
+    workers = available_cpus()
+    step = max(1, min(PAGE_BATCH_SIZE, -(-page_count // workers)))
+    page_ranges = [
+        range(start, min(start + step, page_count))
+        for start in range(0, page_count, step)
+    ]
+    if not page_ranges:
+        return
+
+    seen_pairs = set()
+    for results in iter_range_results(pdf_path, page_ranges, workers):
+        for page_index, headings in results:
+            page_entries = []
+            for level, candidate in headings:
+                pair_key = (level, candidate.lower())
+                if pair_key in seen_pairs:
+                    continue
+                seen_pairs.add(pair_key)
+                page_entries.append(
+                    {"rank": level, "title": candidate, "page": page_index + 1}
+                )
+            # Pages arrive in order, so sorting each page by rank
+            # yields entries ordered by (page, rank) overall.
+            page_entries.sort(key=lambda x: x["rank"])
+            yield from page_entries
 
 
 def build_nested_toc(flat_entries):
@@ -167,22 +246,25 @@ def build_nested_toc(flat_entries):
     return nested
 
 
+def count_elements(nodes):
+    return sum(1 + count_elements(n.get("children", [])) for n in nodes)
+
+
 def main():
     if not INPUT_PATH.exists():
         raise FileNotFoundError(f"Input PDF not found: {INPUT_PATH}")
 
-    flat_toc = extract_flat_toc(INPUT_PATH)
-    nested_toc = build_nested_toc(flat_toc)
+    nested_toc = build_nested_toc(extract_flat_toc(INPUT_PATH))
 
     book_structure = {
         "file": str(INPUT_PATH),
-        "total_elements": len(flat_toc),
+        "total_elements": count_elements(nested_toc),
         "toc": nested_toc,
     }
 
     OUTPUT_PATH.parent.mkdir(parents=True, exist_ok=True)
     with open(OUTPUT_PATH, "w", encoding="utf-8") as f:
-        json.dump(book_structure, f, ensure_ascii=False, indent=2)
+        f.write(json.dumps(book_structure, ensure_ascii=False, indent=2))
 
 
 if __name__ == "__main__":